@@ -1,12 +1,13 @@
 # app.py
 # Ejecuta: streamlit run app.py
-import uuid
-import pandas as pd
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import streamlit as st
 
 st.set_page_config(page_title="Riesgo de Crédito", page_icon="💳")
 
-from utils_model import cargar_modelo, banda_riesgo, enviar_email_simple
+from utils_model import cargar_modelo, compilar_predictor, banda_riesgo, enviar_email_simple
 
 st.title("💳 Formulario de Crédito — Evaluación de Riesgo")
 st.markdown("[🌐 Visita nuestra página web](https://www.labdatosperu.org/capacitaciones/machine-learning-con-python)")
@@ -17,7 +18,44 @@ st.markdown("[🎥 Enlace a la grabación del taller](https://us06web.zoom.us/cl
 def _modelo():
     return cargar_modelo("modelo_credito.joblib")
 
+# Predicción especializada a partir de los coeficientes del modelo (cacheada con él)
+@st.cache_resource
+def _predictor():
+    return compilar_predictor(_modelo())
+
 modelo = _modelo()
+predecir = _predictor()
+# Orden de columnas con el que se entrenó el pipeline
+COLUMNAS = list(modelo.feature_names_in_)
+
+# Plantillas del correo, compiladas una sola vez
+_CUERPO_CORREO = (
+    "🎉 ¡Gracias por participar en el taller de hoy!\n\n"
+    "Como agradecimiento, obtienes un **descuento especial** en el curso Machine Learning con Python.\n\n"
+    "Detalles de tu simulación:\n"
+    "- Salario mensual: S/ {salario:,.2f}\n"
+    "- Monto del préstamo: S/ {monto:,.2f}\n"
+    "- Plazo: {plazo} meses\n\n"
+    "Resultado del modelo:\n"
+    "- Probabilidad estimada de default: {prob_pct:.1f}%\n"
+    "- Nivel de riesgo: {nivel}\n\n"
+    "ID de referencia: {envio_id}\n\n"
+    "¡Felicitaciones y gracias por confiar en nosotros!"
+).format_map
+_ASUNTO_CORREO = "Confirmación y descuento especial — Formulario de Crédito (ID {envio_id})".format
+
+# Pool compartido para enviar correos sin bloquear el rerun del script
+@st.cache_resource
+def _mail_executor():
+    return ThreadPoolExecutor(max_workers=2)
+
+# Mientras el envío está en curso, solo este fragmento se re-ejecuta cada segundo
+@st.fragment(run_every=1)
+def _esperar_envio():
+    envio = st.session_state.envio
+    if envio["fut"].done():
+        st.rerun()
+    st.info(f"⏳ Enviando correo (ID {envio['id']})...")
 
 # Entradas
 c1, c2, c3 = st.columns(3)
@@ -30,8 +68,9 @@ if "ultimo" not in st.session_state:
     st.session_state.ultimo = None  # guardará dict con salario, monto, plazo, prob, nivel
 
 if st.button("Calcular riesgo"):
-    X = pd.DataFrame([{"salario": salario, "monto": monto, "plazo": plazo}])
-    prob = float(modelo.predict_proba(X)[0, 1])
+    valores = {"salario": salario, "monto": monto, "plazo": plazo}
+    X = np.array([[valores[c] for c in COLUMNAS]], dtype=np.float64)
+    prob = float(predecir(X)[0])
     nivel = banda_riesgo(prob)
     st.session_state.ultimo = {
         "salario": salario, "monto": monto, "plazo": plazo, "prob": prob, "nivel": nivel
@@ -54,36 +93,40 @@ if st.session_state.ultimo:
         enviar = st.form_submit_button("Enviar correo", disabled=deshabilitar_envio)
 
     if enviar:
+        # Mismo correo + misma simulación = envío duplicado (doble clic o rerun)
+        token = hash((email.strip().lower(), u["salario"], u["monto"], u["plazo"], u["prob"]))
         if not email.strip():
             st.error("Por favor, coloca un correo válido.")
+        elif "envio" in st.session_state:
+            st.info("Ya hay un envío en curso; espera a que termine.")
+        elif st.session_state.get("ultimo_envio") == token:
+            st.info("Este resultado ya fue enviado a ese correo.")
         else:
-            envio_id = str(uuid.uuid4())[:8]
-            cuerpo = (
-                "🎉 ¡Gracias por participar en el taller de hoy!\n\n"
-                "Como agradecimiento, obtienes un **descuento especial** en el curso Machine Learning con Python.\n\n"
-                "Detalles de tu simulación:\n"
-                f"- Salario mensual: S/ {u['salario']:,.2f}\n"
-                f"- Monto del préstamo: S/ {u['monto']:,.2f}\n"
-                f"- Plazo: {u['plazo']} meses\n\n"
-                "Resultado del modelo:\n"
-                f"- Probabilidad estimada de default: {u['prob']*100:.1f}%\n"
-                f"- Nivel de riesgo: {u['nivel']}\n\n"
-                f"ID de referencia: {envio_id}\n\n"
-                "¡Felicitaciones y gracias por confiar en nosotros!"
+            envio_id = secrets.token_urlsafe(6)
+            cuerpo = _CUERPO_CORREO({**u, "envio_id": envio_id, "prob_pct": u["prob"] * 100})
+
+            fut = _mail_executor().submit(
+                enviar_email_simple,
+                destinatario=email,
+                asunto=_ASUNTO_CORREO(envio_id=envio_id),
+                cuerpo_texto=cuerpo
             )
-
-            with st.spinner("Enviando correo..."):
-                ok, msg = enviar_email_simple(
-                    destinatario=email,
-                    asunto=f"Confirmación y descuento especial — Formulario de Crédito (ID {envio_id})",
-                    cuerpo_texto=cuerpo
-                )
-
-            if ok:
-                st.success(f"✅ Correo enviado (ID {envio_id}). Revisa tu bandeja de entrada/spam.")
-                st.toast("Correo enviado ✅", icon="✅")
-            else:
-                st.error(f"❌ No se pudo enviar el correo (ID {envio_id}). Detalle: {msg}")
-                st.toast("Fallo al enviar correo ❌", icon="❌")
+            st.session_state.envio = {"id": envio_id, "fut": fut, "token": token}
+            st.rerun()
+
+    # Envío en segundo plano: esperar o mostrar el resultado una sola vez
+    envio = st.session_state.get("envio")
+    if envio and not envio["fut"].done():
+        _esperar_envio()
+    elif envio:
+        del st.session_state.envio
+        ok, msg = envio["fut"].result()
+        if ok:
+            st.session_state.ultimo_envio = envio["token"]
+            st.success(f"✅ Correo enviado (ID {envio['id']}). Revisa tu bandeja de entrada/spam.")
+            st.toast("Correo enviado ✅", icon="✅")
+        else:
+            st.error(f"❌ No se pudo enviar el correo (ID {envio['id']}). Detalle: {msg}")
+            st.toast("Fallo al enviar correo ❌", icon="❌")
 
 
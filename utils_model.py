@@ -1,64 +1,179 @@
 # utils_model.py
 # Utilidades: bandas, carga de modelo, envío de correo y diagnóstico SMTP.
 
-import os, socket, ssl, smtplib
+import os, atexit, threading
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
 import joblib
-from email.message import EmailMessage
+import numpy as np
 
-# (opcional) carga .env local
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except Exception:
-    pass
+# (opcional) carga .env local: como find_dotenv(), busca desde la carpeta del código
+# hacia arriba, pero solo importa dotenv si encuentra el archivo
+def _buscar_env():
+    carpeta = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        ruta = os.path.join(carpeta, ".env")
+        if os.path.isfile(ruta):
+            return ruta
+        padre = os.path.dirname(carpeta)
+        if padre == carpeta:
+            return None
+        carpeta = padre
+
+_ENV_PATH = _buscar_env()
+if _ENV_PATH:
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(_ENV_PATH)
+    except Exception:
+        pass
 
 BANDAS_RIESGO = [
     ("Bajo",  0.00, 0.20),
     ("Medio", 0.20, 0.50),
     ("Alto",  0.50, 1.01),
 ]
+# Límites superiores y nombres en paralelo para búsqueda binaria
+_BANDA_HI = tuple(hi for _, _, hi in BANDAS_RIESGO)
+_BANDA_NAMES = tuple(nombre for nombre, _, _ in BANDAS_RIESGO)
+_BANDA_LO = BANDAS_RIESGO[0][1]
+
+# Parche de compatibilidad para pickles creados con otra versión de scikit-learn:
+# "Can't get attribute '_RemainderColsList' on sklearn.compose._column_transformer".
+# Se aplica antes de cualquier carga para no deserializar el modelo dos veces.
+try:
+    import sklearn.compose._column_transformer as _ct  # type: ignore
+    # Basta con mapearlo a list para que el unpickler resuelva el símbolo
+    _ct.__dict__.setdefault("_RemainderColsList", list)
+except Exception:
+    pass
 
 def cargar_modelo(path: str = "modelo_logit_credito.joblib"):
     """
-    Carga el modelo .joblib.
-    Aplica un parche de compatibilidad si aparece el error:
-    "Can't get attribute '_RemainderColsList' on sklearn.compose._column_transformer"
-    que puede surgir al migrar entre versiones de scikit-learn.
+    Carga el modelo .joblib (el parche de _RemainderColsList ya está aplicado).
+    Los arreglos numpy se mapean en memoria de solo lectura: el SO los comparte
+    entre procesos y los pagina bajo demanda en lugar de copiarlos al heap.
     """
+    return joblib.load(path, mmap_mode="r")
+
+def _lineal_binario(est):
+    """(w, b) de una LogisticRegression binaria (OvR); None si es otro estimador."""
+    from sklearn.linear_model import LogisticRegression
+    # Con multi_class="multinomial" predict_proba usa softmax (sigmoid(2·d)), no sigmoid(d)
+    if (isinstance(est, LogisticRegression) and est.coef_.shape[0] == 1
+            and getattr(est, "multi_class", "auto") != "multinomial"):
+        return np.asarray(est.coef_[0], dtype=np.float64), float(est.intercept_[0])
+    return None
+
+def compilar_predictor(modelo):
+    """
+    Retorna f(X) -> P(clase 1), con X un arreglo (n, d) en el orden de
+    modelo.feature_names_in_.
+    Si el pipeline es StandardScaler → LogisticRegression (opcionalmente
+    calibrada con sigmoid), lo evalúa con numpy a partir de los coeficientes;
+    en otro caso delega en modelo.predict_proba.
+    """
+    columnas = list(modelo.feature_names_in_)
+
+    def _generico(X):
+        import pandas as pd
+        return modelo.predict_proba(pd.DataFrame(X, columns=columnas))[:, 1]
+
     try:
-        return joblib.load(path)
-    except AttributeError as e:
-        msg = str(e)
-        if "_RemainderColsList" in msg:
-            # Parche de compatibilidad: inyectar símbolo esperado por pickles antiguos
-            try:
-                import sklearn.compose._column_transformer as ct  # type: ignore
-                if not hasattr(ct, "_RemainderColsList"):
-                    # Basta con mapearlo a list para que el unpickler resuelva el símbolo
-                    setattr(ct, "_RemainderColsList", list)
-            except Exception:
-                # Si no pudimos importar/inyectar, relanzamos el error original
-                raise
-            # Reintentar la carga tras el parche
-            return joblib.load(path)
-        # Otros AttributeError: relanzar
-        raise
+        from sklearn.calibration import CalibratedClassifierCV
+        from sklearn.compose import ColumnTransformer
+        from sklearn.preprocessing import StandardScaler
+
+        (_, pre), (_, clf) = modelo.steps
+        activos = [(t, c) for _, t, c in pre.transformers_ if t != "drop"]
+        if not isinstance(pre, ColumnTransformer) or len(activos) != 1:
+            return _generico
+        scaler, cols = activos[0]
+        if not isinstance(scaler, StandardScaler) or list(cols) != columnas:
+            return _generico
+        mu = scaler.mean_ if scaler.with_mean else 0.0
+        sd = scaler.scale_ if scaler.with_std else 1.0
+
+        # Cada término: sigmoide calibrada 1/(1+exp(a·(w·z+b)+c)); sin calibrar a=-1, c=0
+        terminos = []
+        if isinstance(clf, CalibratedClassifierCV):
+            if clf.method != "sigmoid":
+                return _generico
+            for cc in clf.calibrated_classifiers_:
+                wb = _lineal_binario(cc.estimator)
+                if wb is None or len(cc.calibrators) != 1:
+                    return _generico
+                cal = cc.calibrators[0]
+                terminos.append((*wb, float(cal.a_), float(cal.b_)))
+        else:
+            wb = _lineal_binario(clf)
+            if wb is None:
+                return _generico
+            terminos.append((*wb, -1.0, 0.0))
+    except Exception:
+        return _generico
+
+    W = np.array([t[0] for t in terminos])           # (k, d)
+    B, A, C = (np.array([t[i] for t in terminos]) for i in (1, 2, 3))
+    # Se pliega el escalado en los pesos: w·((x-mu)/sd) + b = (w/sd)·x + (b - w·mu/sd)
+    W_x = W / sd
+    B_x = B - W_x @ np.broadcast_to(mu, W.shape[1])
+
+    def _rapido(X):
+        d = np.asarray(X, dtype=np.float64) @ W_x.T + B_x
+        return (1.0 / (1.0 + np.exp(A * d + C))).mean(axis=1)
+
+    # Verificación: en filas de prueba alrededor de la media debe coincidir con el pipeline
+    try:
+        centro = np.broadcast_to(mu, W.shape[1])
+        escala = np.broadcast_to(sd, W.shape[1])
+        sonda = np.vstack([centro, centro + escala, centro - 2 * escala])
+        if not np.allclose(_rapido(sonda), _generico(sonda), rtol=0, atol=1e-9):
+            return _generico
+    except Exception:
+        return _generico
+    return _rapido
 
 def banda_riesgo(p: float) -> str:
-    for nombre, lo, hi in BANDAS_RIESGO:
-        if lo <= p < hi:
-            return nombre
-    return "N/A"
-
-def _smtp_cfg():
-    cfg = {
-        "host": os.environ.get("SMTP_HOST"),
-        "port": int(os.environ.get("SMTP_PORT", "587")),
-        "user": os.environ.get("SMTP_USER"),
-        "pwd":  os.environ.get("SMTP_PASS"),
-        "from": os.environ.get("SMTP_FROM") or os.environ.get("SMTP_USER"),
-    }
-    return cfg
+    if not (_BANDA_LO <= p < _BANDA_HI[-1]):
+        return "N/A"
+    return _BANDA_NAMES[bisect_right(_BANDA_HI, p)]
+
+# Versión vectorizada: el último índice corresponde a "N/A" (fuera de rango o NaN)
+_BANDA_HI_ARR = np.asarray(_BANDA_HI)
+_BANDA_NAMES_ARR = np.asarray(_BANDA_NAMES + ("N/A",), dtype=object)
+
+def banda_riesgo_bulk(probs) -> np.ndarray:
+    """Igual que banda_riesgo, pero para un arreglo de probabilidades."""
+    p = np.asarray(probs, dtype=np.float64)
+    dentro = (p >= _BANDA_LO) & (p < _BANDA_HI[-1])
+    idx = np.where(dentro, np.searchsorted(_BANDA_HI_ARR, p, side="right"), len(_BANDA_NAMES))
+    return _BANDA_NAMES_ARR[idx]
+
+def predict_bulk(modelo, df) -> np.ndarray:
+    """P(clase 1) para todas las filas de df con una sola llamada al pipeline."""
+    return modelo.predict_proba(df[list(modelo.feature_names_in_)])[:, 1]
+
+SmtpCfg = namedtuple("SmtpCfg", "host port user pwd from_ complete from_mismatch")
+
+@lru_cache(maxsize=1)
+def _smtp_cfg() -> SmtpCfg:
+    """
+    Lee la configuración SMTP del entorno una sola vez por proceso.
+    Si cambian las variables (p. ej. en pruebas), llamar a _smtp_cfg.cache_clear().
+    """
+    host = os.environ.get("SMTP_HOST")
+    port = int(os.environ.get("SMTP_PORT", "587"))
+    user = os.environ.get("SMTP_USER")
+    pwd = os.environ.get("SMTP_PASS")
+    from_ = os.environ.get("SMTP_FROM") or user
+    return SmtpCfg(
+        host, port, user, pwd, from_,
+        complete=all((host, port, user, pwd, from_)),
+        # Reglas de Gmail: FROM debe ser igual a USER (salvo alias verificado)
+        from_mismatch=bool(user and from_ and user.lower() != from_.lower()),
+    )
 
 def _mask(v):
     if not v: return ""
@@ -68,53 +183,54 @@ def _mask(v):
 def validar_smtp_env():
     cfg = _smtp_cfg()
     faltan = [k for k,v in [
-        ("SMTP_HOST", cfg["host"]), ("SMTP_PORT", cfg["port"]),
-        ("SMTP_USER", cfg["user"]), ("SMTP_PASS", cfg["pwd"]),
-        ("SMTP_FROM", cfg["from"])
+        ("SMTP_HOST", cfg.host), ("SMTP_PORT", cfg.port),
+        ("SMTP_USER", cfg.user), ("SMTP_PASS", cfg.pwd),
+        ("SMTP_FROM", cfg.from_)
     ] if not v]
-    masked = {"host": _mask(cfg["host"]), "port": cfg["port"], "user": _mask(cfg["user"]),
-              "pwd": _mask(cfg["pwd"]), "from": _mask(cfg["from"])}
+    masked = {"host": _mask(cfg.host), "port": cfg.port, "user": _mask(cfg.user),
+              "pwd": _mask(cfg.pwd), "from": _mask(cfg.from_)}
     # Reglas de Gmail: FROM debe ser igual a USER (salvo alias verificado)
     warning_from = None
-    if cfg["user"] and cfg["from"] and cfg["user"].lower() != cfg["from"].lower():
+    if cfg.from_mismatch:
         warning_from = "En Gmail, SMTP_FROM debe ser igual a SMTP_USER (salvo alias verificado en la cuenta)."
     return (len(faltan)==0), faltan, masked, warning_from
 
 def diagnostico_smtp_avanzado(timeout=10):
     """Retorna pasos de diagnóstico: DNS, socket, protocolo, auth."""
+    import smtplib, utils_smtp
     cfg = _smtp_cfg()
     pasos = []
 
-    if not all([cfg["host"], cfg["port"], cfg["user"], cfg["pwd"], cfg["from"]]):
+    if not cfg.complete:
         return {"ok": False, "pasos": [{"paso":"variables","ok":False,"detalle":"Faltan variables en .env"}]}
 
     # Paso 1: DNS
     try:
-        ip = socket.gethostbyname(cfg["host"])
-        pasos.append({"paso":"DNS", "ok": True, "detalle": f"{cfg['host']} → {ip}"})
+        ips = sorted({sa[0] for *_, sa in utils_smtp.resolver(cfg.host, cfg.port)})
+        pasos.append({"paso":"DNS", "ok": True, "detalle": f"{cfg.host} → {', '.join(ips)}"})
     except Exception as e:
         return {"ok": False, "pasos": [{"paso":"DNS","ok":False,"detalle":str(e)}]}
 
     # Paso 2: Conexión de socket
     try:
-        with socket.create_connection((cfg["host"], cfg["port"]), timeout=timeout) as _s:
-            pasos.append({"paso":"Socket", "ok": True, "detalle": f"Conectó a {cfg['host']}:{cfg['port']}"})
+        with utils_smtp.conectar(cfg.host, cfg.port, timeout) as _s:
+            pasos.append({"paso":"Socket", "ok": True, "detalle": f"Conectó a {cfg.host}:{cfg.port}"})
     except Exception as e:
+        utils_smtp.resolver.cache_clear()
         return {"ok": False, "pasos": pasos + [{"paso":"Socket","ok":False,"detalle":str(e)}]}
 
     # Paso 3 y 4: Protocolo + AUTH
     try:
-        if cfg["port"] == 465:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(cfg["host"], cfg["port"], context=context, timeout=timeout) as server:
-                server.login(cfg["user"], cfg["pwd"])
+        if cfg.port == 465:
+            with utils_smtp.SMTP_SSL(cfg.host, cfg.port, context=utils_smtp.SSL_CTX, timeout=timeout) as server:
+                server.login(cfg.user, cfg.pwd)
                 pasos.append({"paso":"SSL(465)+AUTH", "ok": True, "detalle":"Login OK"})
         else:
-            with smtplib.SMTP(cfg["host"], cfg["port"], timeout=timeout) as server:
+            with utils_smtp.SMTP(cfg.host, cfg.port, timeout=timeout) as server:
+                # starttls() hace el EHLO inicial si hace falta
+                server.starttls(context=utils_smtp.SSL_CTX)
                 server.ehlo()
-                server.starttls(context=ssl.create_default_context())
-                server.ehlo()
-                server.login(cfg["user"], cfg["pwd"])
+                server.login(cfg.user, cfg.pwd)
                 pasos.append({"paso":"STARTTLS(587)+AUTH", "ok": True, "detalle":"Login OK"})
     except smtplib.SMTPAuthenticationError as e:
         pasos.append({"paso":"AUTH", "ok": False, "detalle": f"Autenticación falló: {e}"})
@@ -128,53 +244,191 @@ def diagnostico_smtp_avanzado(timeout=10):
 
     return {"ok": True, "pasos": pasos}
 
+# Conexión SMTP persistente compartida por todas las sesiones del proceso.
+# smtplib no es thread-safe, así que el acceso se serializa con _smtp_lock.
+_smtp_lock = threading.Lock()
+_smtp_server = None
+
+def _smtp_conectar(cfg: SmtpCfg, timeout: int):
+    """Abre y autentica una conexión nueva (SSL si port==465, si no STARTTLS)."""
+    import utils_smtp
+    try:
+        if cfg.port == 465:
+            server = utils_smtp.SMTP_SSL(cfg.host, cfg.port, context=utils_smtp.SSL_CTX, timeout=timeout)
+        else:
+            server = utils_smtp.SMTP(cfg.host, cfg.port, timeout=timeout)
+    except OSError:
+        # Las direcciones cacheadas pudieron quedar obsoletas: volver a resolver en el próximo intento
+        utils_smtp.resolver.cache_clear()
+        raise
+    try:
+        if cfg.port != 465:
+            # starttls() hace el EHLO inicial si hace falta; tras TLS las capacidades cambian
+            server.starttls(context=utils_smtp.SSL_CTX)
+            server.ehlo()
+        server.login(cfg.user, cfg.pwd)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def _smtp_cerrar():
+    """Cierra la conexión compartida (si existe) sin propagar errores."""
+    global _smtp_server
+    if _smtp_server is not None:
+        try:
+            _smtp_server.quit()
+        except Exception:
+            _smtp_server.close()
+        _smtp_server = None
+
+def _smtp_connection(timeout: int = 15):
+    """
+    Devuelve la conexión SMTP autenticada compartida.
+    Antes de reutilizarla comprueba con NOOP que siga viva; si no, reconecta.
+    Debe llamarse con _smtp_lock adquirido.
+    """
+    import smtplib
+    global _smtp_server
+    if _smtp_server is not None:
+        try:
+            code, _ = _smtp_server.noop()
+        except (smtplib.SMTPException, OSError):
+            code = None
+        if code == 250:
+            return _smtp_server
+        _smtp_cerrar()
+    _smtp_server = _smtp_conectar(_smtp_cfg(), timeout)
+    return _smtp_server
+
+atexit.register(_smtp_cerrar)
+
+_HTML_TMPL = "<html><body><p>{body}</p></body></html>"
+
+def _armar_msg(destinatario: str, asunto: str, cuerpo_texto: str, from_: str):
+    """EmailMessage con parte de texto y alternativa HTML."""
+    import html
+    from email.message import EmailMessage
+
+    # HTML seguro: se escapa el texto antes de convertir saltos de línea
+    html_doc = _HTML_TMPL.format(body=html.escape(cuerpo_texto).replace("\n", "<br>"))
+
+    msg = EmailMessage()
+    msg["Subject"] = asunto
+    msg["From"] = from_
+    msg["To"] = destinatario
+    msg.set_content(cuerpo_texto)
+    msg.add_alternative(html_doc, subtype="html")
+    return msg
+
 def enviar_email_simple(destinatario: str, asunto: str, cuerpo_texto: str, timeout: int = 15):
     """
     Envía correo; usa SSL si port==465, si no STARTTLS. Retorna (ok, msg).
     - Valida variables de entorno SMTP.
+    - Reutiliza una conexión autenticada persistente entre envíos.
     - En Gmail, exige FROM == USER (salvo alias verificado).
-    - Arma HTML seguro sin usar comillas triples.
+    - Arma la parte HTML escapando el texto.
     """
+    import smtplib
     cfg = _smtp_cfg()
-    if not all([cfg["host"], cfg["port"], cfg["user"], cfg["pwd"], cfg["from"]]):
+    if not cfg.complete:
         return False, "Faltan variables de entorno SMTP."
 
     # Gmail: exigir FROM==USER para evitar rechazo silencioso
-    if cfg["user"] and cfg["from"] and cfg["user"].lower() != cfg["from"].lower():
+    if cfg.from_mismatch:
         return False, "Para Gmail, SMTP_FROM debe ser igual a SMTP_USER (salvo alias verificado)."
 
-    # HTML seguro (sin f-string con backslashes ni triple quotes)
-    cuerpo_html = (cuerpo_texto or "").replace("\n", "<br>")
-    html = (
-        "<html><body>"
-        f"<p>{cuerpo_html}</p>"
-        "</body></html>"
-    )
-
     try:
-        msg = EmailMessage()
-        msg["Subject"] = asunto
-        msg["From"] = cfg["from"]
-        msg["To"] = destinatario
-        msg.set_content(cuerpo_texto or "")
-        msg.add_alternative(html, subtype="html")
-
-        if cfg["port"] == 465:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(cfg["host"], cfg["port"], context=context, timeout=timeout) as server:
-                server.login(cfg["user"], cfg["pwd"])
-                server.send_message(msg)
-        else:
-            with smtplib.SMTP(cfg["host"], cfg["port"], timeout=timeout) as server:
-                server.ehlo()
-                server.starttls(context=ssl.create_default_context())
-                server.ehlo()
-                server.login(cfg["user"], cfg["pwd"])
-                server.send_message(msg)
+        msg = _armar_msg(destinatario, asunto, cuerpo_texto or "", cfg.from_)
+
+        with _smtp_lock:
+            try:
+                _smtp_connection(timeout).send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # El servidor cerró la sesión entre NOOP y envío: reconectar una vez
+                _smtp_cerrar()
+                _smtp_connection(timeout).send_message(msg)
         return True, "OK"
-    except smtplib.SMTPAuthenticationError as e:
-        return False, f"Autenticación falló: {e}"
-    except smtplib.SMTPException as e:
-        return False, f"Error SMTP: {e}"
     except Exception as e:
-        return False, f"Error general: {e}"
+        return False, _detalle_error(e)
+
+def _detalle_error(e: Exception) -> str:
+    import smtplib
+    if isinstance(e, smtplib.SMTPAuthenticationError):
+        return f"Autenticación falló: {e}"
+    if isinstance(e, smtplib.SMTPException):
+        return f"Error SMTP: {e}"
+    return f"Error general: {e}"
+
+def _enviar_porcion(porcion, cuota: int, pausa: float, timeout: int):
+    """
+    Worker de enviar_email_bulk: envía su porción por una sola conexión,
+    pausando `pausa` segundos cada `cuota` correos. Retorna [(ok, msg), ...].
+    Si no logra (re)conectar o autenticarse, marca como fallido el resto de la porción.
+    """
+    import smtplib, time
+    cfg = _smtp_cfg()
+    resultados = []
+    server = None
+    try:
+        for i, (destinatario, asunto, cuerpo_texto) in enumerate(porcion):
+            if i and i % cuota == 0:
+                time.sleep(pausa)
+            try:
+                msg = _armar_msg(destinatario, asunto, cuerpo_texto or "", cfg.from_)
+                if server is None:
+                    server = _smtp_conectar(cfg, timeout)
+                try:
+                    server.send_message(msg)
+                except smtplib.SMTPServerDisconnected:
+                    # Sesión cerrada por el servidor (o tras un error): reconectar una vez
+                    server = None
+                    server = _smtp_conectar(cfg, timeout)
+                    server.send_message(msg)
+                resultados.append((True, "OK"))
+            except Exception as e:
+                if server is None:
+                    # Falló la conexión o el login: reintentar por cada correo solo
+                    # multiplicaría el timeout, así que se descarta el resto
+                    resultados += [(False, _detalle_error(e))] * (len(porcion) - i)
+                    break
+                resultados.append((False, _detalle_error(e)))
+    finally:
+        if server is not None:
+            try:
+                server.quit()
+            except Exception:
+                server.close()
+    return resultados
+
+def enviar_email_bulk(items, batch: int = 50, workers: int = 4, pausa: float = 1.0, timeout: int = 15):
+    """
+    Envío masivo. `items` es un iterable de (destinatario, asunto, cuerpo_texto).
+    Reparte los correos entre `workers` procesos; cada uno usa una conexión
+    persistente (con PIPELINING si el servidor lo soporta). El límite es global:
+    entre todos los procesos se envían como máximo `batch` correos cada `pausa`
+    segundos. Retorna [(ok, msg), ...] en el mismo orden que `items`.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from itertools import chain
+    if batch < 1 or workers < 1:
+        raise ValueError("batch y workers deben ser >= 1")
+    items = list(items)
+    cfg = _smtp_cfg()
+    if not cfg.complete:
+        return [(False, "Faltan variables de entorno SMTP.")] * len(items)
+    if cfg.from_mismatch:
+        return [(False, "Para Gmail, SMTP_FROM debe ser igual a SMTP_USER (salvo alias verificado).")] * len(items)
+    if not items:
+        return []
+
+    # No abrir más procesos (ni conexiones) de los que justifica el volumen, y
+    # repartir el límite: cada proceso envía `cuota` correos por pausa, en total <= batch
+    workers = min(workers, batch, -(-len(items) // batch))
+    cuota = batch // workers
+    tam = -(-len(items) // workers)
+    porciones = [items[i:i + tam] for i in range(0, len(items), tam)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        partes = pool.map(_enviar_porcion, porciones,
+                          [cuota] * len(porciones), [pausa] * len(porciones), [timeout] * len(porciones))
+        return list(chain.from_iterable(partes))
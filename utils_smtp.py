@@ -0,0 +1,125 @@
+# utils_smtp.py
+# Transporte SMTP: contexto TLS, caché DNS y clientes SMTP/SMTP_SSL con PIPELINING.
+# utils_model lo importa al enviar: así smtplib y la carga de CAs del contexto TLS
+# solo ocurren si se usa el correo (ssl y email ya los importa streamlit).
+
+import re, socket, ssl, smtplib
+from functools import lru_cache
+
+# Contexto TLS compartido: carga el bundle de CAs una sola vez (SSLContext es reutilizable)
+SSL_CTX = ssl.create_default_context()
+
+@lru_cache(maxsize=4)
+def resolver(host: str, port: int) -> tuple:
+    """
+    Direcciones de getaddrinfo (IPv4 e IPv6) para host:port, resueltas una vez.
+    Se limpia con resolver.cache_clear() si falla la conexión.
+    """
+    return tuple(socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM))
+
+def conectar(host: str, port: int, timeout, source_address=None) -> socket.socket:
+    """Como socket.create_connection, pero prueba en orden las direcciones cacheadas."""
+    error = None
+    for af, socktype, proto, _, sa in resolver(host, port):
+        sock = None
+        try:
+            sock = socket.socket(af, socktype, proto)
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sa)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error or OSError(f"getaddrinfo no devolvió direcciones para {host}")
+
+@lru_cache(maxsize=1)
+def fqdn_local() -> str:
+    """Nombre local para EHLO (smtplib haría socket.getfqdn() en cada conexión)."""
+    return socket.getfqdn()
+
+class _SocketResueltoMixin:
+    """
+    Conecta el socket TCP a las direcciones cacheadas, pero deja self._host con el
+    nombre para que SNI y la validación del certificado (SSL/STARTTLS) usen el hostname.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("local_hostname", fqdn_local())
+        super().__init__(*args, **kwargs)
+
+    def _get_socket(self, host, port, timeout):
+        if timeout is not None and not timeout:
+            raise ValueError("Non-blocking socket (timeout=0) is not supported")
+        sock = conectar(host, port, timeout, self.source_address)
+        if isinstance(self, smtplib.SMTP_SSL):
+            sock = self.context.wrap_socket(sock, server_hostname=self._host)
+        return sock
+
+def _opciones(opts) -> str:
+    return (" " + " ".join(opts)) if opts else ""
+
+class _PipeliningMixin:
+    """
+    sendmail con PIPELINING (RFC 2920): si el servidor lo anuncia, escribe
+    MAIL FROM, todos los RCPT TO y DATA de una vez y luego lee las respuestas,
+    en lugar de esperar un RTT por comando. Si no, usa el sendmail estándar.
+    """
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn("pipelining") or any(o.lower() == "smtputf8" for o in mail_options):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if isinstance(msg, str):
+            msg = re.sub(r"(?:\r\n|\n|\r(?!\n))", "\r\n", msg).encode("ascii")
+        mail_opts = list(mail_options)
+        if self.has_extn("size"):
+            mail_opts.append("size=%d" % len(msg))
+
+        cmds = ["mail FROM:%s%s" % (smtplib.quoteaddr(from_addr), _opciones(mail_opts))]
+        cmds += ["rcpt TO:%s%s" % (smtplib.quoteaddr(r), _opciones(rcpt_options)) for r in to_addrs]
+        cmds.append("data")
+        if any("\r" in c or "\n" in c for c in cmds):
+            raise ValueError("Comando SMTP con saltos de línea")
+        self.send("".join(c + "\r\n" for c in cmds))
+        # Leer siempre todas las respuestas para no desincronizar la sesión
+        respuestas = [self.getreply() for _ in cmds]
+        (code, resp), (dcode, dresp) = respuestas[0], respuestas[-1]
+        senderrs = {r: cr for r, cr in zip(to_addrs, respuestas[1:-1]) if cr[0] not in (250, 251)}
+
+        error = None
+        if code != 250:
+            error = smtplib.SMTPSenderRefused(code, resp, from_addr)
+        elif len(senderrs) == len(to_addrs):
+            error = smtplib.SMTPRecipientsRefused(senderrs)
+        elif dcode != 354:
+            error = smtplib.SMTPDataError(dcode, dresp)
+        if error is not None:
+            # Con DATA aceptado no hay forma segura de abortar: cerrar la sesión
+            if dcode == 354 or 421 in (code, dcode):
+                self.close()
+            else:
+                self._rset()
+            raise error
+
+        q = re.sub(br"(?m)^\.", b"..", msg)
+        if q[-2:] != b"\r\n":
+            q += b"\r\n"
+        self.send(q + b".\r\n")
+        code, resp = self.getreply()
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+class SMTP(_PipeliningMixin, _SocketResueltoMixin, smtplib.SMTP):
+    pass
+
+class SMTP_SSL(_PipeliningMixin, _SocketResueltoMixin, smtplib.SMTP_SSL):
+    pass